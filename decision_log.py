@@ -0,0 +1,124 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+# @File    : decision_log.py
+# @Software: PyCharm
+
+import struct
+import sys
+
+# Each decision is one fixed-size record: slot, vm id, source pm, destination pm, operation, reason code,
+# previous category and current category of the vm. The source and destination are the pms that the vm is really
+# removed from and added to, and a pm id of -1 means there is no such pm. A vm moved from one pm to another is one record
+# with both of them. Operation remove means that the vm is taken off a pm and not placed again, and drop means that the
+# vm is left on a pm which is re-initialized.
+HEADER = struct.Struct('<4sHH')
+RECORD = struct.Struct('<IIiiBBBB')
+MAGIC = b'VMDL'
+VERSION = 1
+
+OPERATIONS = ['new', 'move', 'finish', 'drop', 'remove']
+REASONS = ['insert', 'fill', 'release', 'adjust', 'change', 'finish', 'renew']
+CATEGORIES = [None, 'T', 'S', 'L', 'B']
+
+
+class DecisionLog:
+    """
+    This class is an append-only binary log of placement decisions. Records are buffered and written in blocks, or
+    when flush() is called, which the caller should do at the end of each slot so that a killed run keeps its log.
+    """
+
+    def __init__(self, path, block_records=4096):
+        """
+        :param path: the file that the log is written to
+        :param block_records: the number of records buffered before they are written
+        :type path: str
+        :type block_records: int
+        """
+        self.fp = open(path, 'wb')
+        self.fp.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.block_records = block_records
+        self.block = bytearray(RECORD.size * block_records)
+        self.num = 0
+
+    def write(self, slot, operation, reason, vm, src, dst):
+        # Append the decision of putting vm from pm src to pm dst.
+        RECORD.pack_into(self.block, self.num * RECORD.size, slot, vm.id,
+                         -1 if src is None else src, -1 if dst is None else dst,
+                         OPERATIONS.index(operation), REASONS.index(reason),
+                         CATEGORIES.index(vm.pre_category), CATEGORIES.index(vm.category))
+        self.num += 1
+        if self.num == self.block_records:
+            self.flush()
+
+    def flush(self):
+        self.fp.write(memoryview(self.block)[:self.num * RECORD.size])
+        self.fp.flush()
+        self.num = 0
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+
+def read(path, block_records=4096):
+    # Yield every record in the log as a tuple of (slot, vm_id, src, dst, operation, reason, pre_category, category).
+    # A partial record at the end of a log whose run was killed is ignored.
+    with open(path, 'rb') as fp:
+        header = fp.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('{} is not a decision log of version {}.'.format(path, VERSION))
+        magic, version, size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError('{} is not a decision log of version {}.'.format(path, VERSION))
+        while True:
+            block = fp.read(RECORD.size * block_records)
+            block = block[:len(block) - len(block) % RECORD.size]
+            if not block:
+                break
+            for slot, vm_id, src, dst, op, reason, pre, cur in RECORD.iter_unpack(block):
+                yield slot, vm_id, src, dst, OPERATIONS[op], REASONS[reason], CATEGORIES[pre], CATEGORIES[cur]
+
+
+def apply_record(occupancy, record):
+    # Apply one record to the occupancy of PMs.
+    vm_id, src, dst = record[1:4]
+    if src != -1 and src in occupancy:
+        occupancy[src].discard(vm_id)
+        if not occupancy[src]:
+            del occupancy[src]
+    if dst != -1:
+        occupancy.setdefault(dst, set()).add(vm_id)
+
+
+def replay(path, slot):
+    # Rebuild the occupancy of PMs at the end of the given slot from the log alone, as dict[pm_id:set(vm_id)].
+    occupancy = dict()
+    for record in read(path):
+        if record[0] > slot:
+            break
+        apply_record(occupancy, record)
+    return occupancy
+
+
+def replay_slots(path, num_slots):
+    # Yield the slot and the occupancy of PMs at the end of it for every slot from 0 to num_slots in one pass.
+    occupancy = dict()
+    slot = 0
+    for record in read(path):
+        if record[0] > num_slots:
+            break
+        while slot < record[0]:
+            yield slot, {pm_id: set(vm_ids) for pm_id, vm_ids in occupancy.items()}
+            slot += 1
+        apply_record(occupancy, record)
+    while slot <= num_slots:
+        yield slot, {pm_id: set(vm_ids) for pm_id, vm_ids in occupancy.items()}
+        slot += 1
+
+
+if __name__ == "__main__":
+    # Usage: python decision_log.py <log file> <slot>
+    occupancy = replay(sys.argv[1], int(sys.argv[2]))
+    print('{} PMs is in active state.'.format(len(occupancy)))
+    for pm_id in sorted(occupancy):
+        print('PM-{}: {}'.format(pm_id, sorted(occupancy[pm_id])))
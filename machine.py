@@ -118,6 +118,13 @@ class PhysicalMachine:
             total_demand += vm.current_demand
         return self.capacity - total_demand
 
+    def get_latest_end_time(self):
+        # The time that the last vm running on this pm stops running.
+        latest_end_time = 0
+        for vm in self.running_vms:
+            latest_end_time = max(latest_end_time, vm.end_time)
+        return latest_end_time
+
     def get_category(self):
         # Determine this pm's category according to the vms running on it.
         t_cnt, s_cnt, l_cnt, b_cnt = 0, 0, 0, 0
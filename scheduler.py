@@ -6,6 +6,9 @@
 # @File    : scheduler.py
 # @Software: PyCharm
 
+import time
+from bisect import bisect_left
+from queue import PriorityQueue
 from machine import PhysicalMachine, VirtualMachine
 
 
@@ -15,13 +18,37 @@ class VMScheduler:
     appropriate PMs at each time slot.
     """
 
-    def __init__(self, num_pms, num_slots):
+    def __init__(self, num_pms, num_slots, op_budget=None, time_budget=None, log=None, departure_aware=False):
         """
         :param num_pms:
         :param num_slots:
+        :param op_budget: the number of PM group renewals that deferred work may take in each slot
+        :param time_budget: the number of seconds that deferred work may take in each slot
+        :param log: the log that placement decisions are written to
+        :param departure_aware: whether to prefer PMs whose VMs finish around the same time as the placed VM
+        :type op_budget: int
+        :type time_budget: float
+        :type log: DecisionLog
+        :type departure_aware: bool
         """
         self.num_pms = num_pms
         self.num_slots = num_slots
+        self.op_budget = op_budget
+        self.time_budget = time_budget
+        self.log = log
+        self.departure_aware = departure_aware
+        self.num_migrations = 0
+        self.system_time = 0
+        self.num_ops = 0  # PM group renewals in current slot
+        self.op_overshoot = 0  # PM group renewals over op_budget in current slot
+        self.deferred = PriorityQueue()  # store deferred work, either a VM or a (chain, pm) to be continued
+        self.__queued = set()  # store the work which has an entry in deferred
+        self.__live = dict()  # dict[vm:(pre, cur)] the live deferred category change of each VM
+        self.__chains = set()  # store the (chain, pm) which are waiting to be continued
+        self.__seq = 0
+        self.__slot = 0  # slot that the work being deferred or handled is first deferred in
+        self.__start = 0.0  # time that deferred work starts in current slot
+        self.__budgeted = False  # whether the work being handled is deferred work under the budget
         self.vm_set = list()
         self.vm_new = list()
         self.pm_set = dict()  # dict[id:pm]
@@ -38,11 +65,14 @@ class VMScheduler:
         # Create PM Category
         pm_category = ['B', 'L', 'LT', 'S', 'SS', 'LS', 'T', 'UT', 'ULLT']
         self.pm_groups = dict()
+        self.pm_end_index = dict()  # dict[category:sorted list((latest end time, pm_id))]
         for x in pm_category:
             self.pm_groups[x] = set()
+            self.pm_end_index[x] = list()
 
     def pm_group_renew(self):
         # According to the category of each PM, divide active PMs into different groups.
+        self.num_ops += 1
         self.pm_re_categorize()
         for x in self.pm_groups.keys():
             self.pm_groups[x].clear()
@@ -53,7 +83,7 @@ class VMScheduler:
             pm.update()
             if not pm.category:
                 empty_pm_id.add(pm.id)
-                self.pm_set[pm.id] = PhysicalMachine(pm.id, 1000)
+                self.__reset(pm.id, 'renew')
 
         for pm_id in empty_pm_id:
             self.active_pm_id.discard(pm_id)
@@ -63,6 +93,10 @@ class VMScheduler:
             pm = self.pm_set[pm_id]
             self.pm_groups[pm.category].add(pm)
 
+        if self.departure_aware:
+            for x in self.pm_groups.keys():
+                self.pm_end_index[x] = sorted((pm.get_latest_end_time(), pm.id) for pm in self.pm_groups[x])
+
     def pm_re_categorize(self):
         # Re-categorize the PM, if the number of VMs running on it is none
         # then remove it from active_pm_id set, add it to idle_pm_id and re-initialize the PM.
@@ -74,7 +108,7 @@ class VMScheduler:
         for pm_id in empty_pm_id:
             self.active_pm_id.discard(pm_id)
             self.idle_pm_id.add(pm_id)
-            self.pm_set[pm_id] = PhysicalMachine(pm_id, 1000)
+            self.__reset(pm_id, 'renew')
 
         for pm_id in self.active_pm_id:
             self.pm_set[pm_id].update()
@@ -88,8 +122,11 @@ class VMScheduler:
         for vm in self.vm_set:
             if system_time >= vm.end_time:
                 pm_id = vm.current_pm_id
-                self.pm_set[pm_id].running_vms.discard(vm)
+                if vm in self.pm_set[pm_id].running_vms:
+                    self.pm_set[pm_id].running_vms.discard(vm)
+                    self.__log('finish', 'finish', vm, pm_id, None)
                 finished_vms.add(vm)
+                self.__live.pop(vm, None)
 
         for vm in finished_vms:
             # print('VM-{} finishes its work.'.format(vm.id))
@@ -98,6 +135,14 @@ class VMScheduler:
         for vm in self.vm_set:
             vm.update(system_time)
 
+    def occupancy(self):
+        # The ids of VMs running on each PM, as dict[pm_id:set(vm_id)] which leaves out empty PMs.
+        res = dict()
+        for pm_id, pm in self.pm_set.items():
+            if pm.running_vms:
+                res[pm_id] = set(vm.id for vm in pm.running_vms)
+        return res
+
     def integrate_vm_set(self):
         # After the insert operation of new coming VMs and the change operation of old VMs, we should put them together.
         print('{} PMs is in active state.'.format(len(self.active_pm_id)))
@@ -136,24 +181,60 @@ class VMScheduler:
             result.append(temp)
         return result
 
-    def new(self, vms):
+    def new(self, vms, reason='change', src=None):
         # Put VMs into a new PM. This operation means that we should get a PM from idle PM set and put it into active PM
         # set firstly. Then, VMs are put into the same PM, the new PM's category and PM group state should be updated.
+        # src is the id of the PM that the caller has taken the VMs off, which is logged as their source.
         pm_id = self.idle_pm_id.pop()
         # print('{} is used.'.format(pm_id))
         self.active_pm_id.add(pm_id)
         pm = self.pm_set[pm_id]
         if isinstance(vms, VirtualMachine):
+            if vms.current_pm_id is not None:
+                self.num_migrations += 1
+            self.__log('new', reason, vms, src, pm.id)
             vms.current_pm_id = pm.id
             pm.running_vms.add(vms)
         else:
             for vm in vms:
+                if vm.current_pm_id is not None:
+                    self.num_migrations += 1
+                self.__log('new', reason, vm, src, pm.id)
                 vm.current_pm_id = pm.id
                 pm.running_vms.add(vm)
         pm.update()
         self.pm_group_renew()
         return pm.id
 
+    def __log(self, operation, reason, vm, src, dst):
+        # Write what really happened to vm to the decision log if there is one: src and dst are the ids of the tracked
+        # PMs that vm is removed from and added to, or None. Nothing is written if neither of them is tracked.
+        if self.log is not None and (src is not None or dst is not None):
+            self.log.write(self.system_time, operation, reason, vm, src, dst)
+
+    def __tracked_id(self, pm):
+        # The id of pm if it is the PM object in pm_set, or None if it has been re-initialized since.
+        if self.pm_set.get(pm.id) is pm:
+            return pm.id
+
+    def __remove(self, pm, vm, reason):
+        # Remove vm from pm without putting it anywhere.
+        if vm in pm.running_vms:
+            pm.running_vms.discard(vm)
+            self.__log('remove', reason, vm, self.__tracked_id(pm), None)
+
+    def __take(self, pm, vm):
+        # Take vm off pm to put it somewhere else, and return the id of pm to be logged as its source.
+        if vm in pm.running_vms:
+            pm.running_vms.discard(vm)
+            return self.__tracked_id(pm)
+
+    def __reset(self, pm_id, reason):
+        # Re-initialize the PM, the VMs which are still running on it are dropped.
+        for vm in self.pm_set[pm_id].running_vms:
+            self.__log('drop', reason, vm, pm_id, None)
+        self.pm_set[pm_id] = PhysicalMachine(pm_id, 1000)
+
     def hot(self, pm):
         # If the total demand of VMs running on the PM is larger than its capacity, we call this PM hot.
         total_demand = 0.0
@@ -174,95 +255,135 @@ class VMScheduler:
         else:
             return True
 
-    def __get(self, category, pm=None):
+    def __get(self, category, pm=None, vm=None):
+        # Get a PM of the category other than pm and, if vm is given, other than the PM that vm is leaving, or None.
         num = len(self.pm_groups[category])
         if num > 0:
+            if vm is not None and self.departure_aware:
+                res = self.__get_by_departure(category, vm, pm)
+                if res is not None:
+                    return res
+            excluded = set()
             if pm is not None:
-                if pm.category == category:
-                    self.pm_groups[category].discard(pm)
-            res = self.pm_groups[category].pop()
-            self.pm_groups[category].add(res)
-            if pm is not None:
-                if pm.category == category:
-                    self.pm_groups[category].add(pm)
-            return res
+                excluded.add(pm.id)
+            if vm is not None:
+                excluded.add(vm.current_pm_id)
+            for res in self.pm_groups[category]:
+                if res.id not in excluded:
+                    return res
+
+    def __get_by_departure(self, category, vm, pm=None):
+        # Among the PMs in the category group, choose the one whose latest VM end time is the closest to vm's end time,
+        # so that VMs on the same PM tend to finish together and the PM can be released. Like __get(), pm and the PM
+        # that vm is leaving are never chosen.
+        index = self.pm_end_index[category]
+        right = bisect_left(index, (vm.end_time,))
+        left = right - 1
+        while left >= 0 or right < len(index):
+            # On a tie, the PM that finishes later is preferred, since vm does not extend its latest end time.
+            if right >= len(index) or (left >= 0 and vm.end_time - index[left][0] < index[right][0] - vm.end_time):
+                pm_id = index[left][1]
+                left -= 1
+            else:
+                pm_id = index[right][1]
+                right += 1
+            if pm_id != vm.current_pm_id and (pm is None or pm_id != pm.id):
+                return self.pm_set[pm_id]
 
-    def move(self, vms, pm):
+    def move(self, vms, pm, reason='change', src=None):
         # When we move VMs from its original PMs to the new PM, we should remove it from original PM's running set and
-        # and add it to the new PM's running set.
+        # and add it to the new PM's running set. src is the id of the PM that the caller has already taken the VMs
+        # off, which is logged as their source unless they are still on their original PM.
         if isinstance(vms, VirtualMachine):
             pre_pm_id = vms.current_pm_id
             if pre_pm_id is not None:
+                if pre_pm_id != pm.id:
+                    self.num_migrations += 1
+                if vms in self.pm_set[pre_pm_id].running_vms:
+                    src = pre_pm_id
                 self.pm_set[pre_pm_id].running_vms.discard(vms)
                 if len(self.pm_set[pre_pm_id].running_vms) == 0:
                     self.active_pm_id.discard(pre_pm_id)
                     self.idle_pm_id.add(pre_pm_id)
-                    self.pm_set[pre_pm_id] = PhysicalMachine(pre_pm_id, 1000)
+                    self.__reset(pre_pm_id, reason)
+            self.__log('move', reason, vms, src, self.__tracked_id(pm))
             vms.current_pm_id = pm.id
             pm.running_vms.add(vms)
         else:
 
             for vm in vms:
                 pre_pm_id = vm.current_pm_id
+                origin = src
                 if pre_pm_id is not None:
+                    if pre_pm_id != pm.id:
+                        self.num_migrations += 1
+                    if vm in self.pm_set[pre_pm_id].running_vms:
+                        origin = pre_pm_id
                     self.pm_set[pre_pm_id].running_vms.discard(vm)
                     if len(self.pm_set[pre_pm_id].running_vms) == 0:
                         self.active_pm_id.discard(pre_pm_id)
                         self.idle_pm_id.add(pre_pm_id)
-                        self.pm_set[pre_pm_id] = PhysicalMachine(pre_pm_id, 1000)
+                        self.__reset(pre_pm_id, reason)
+                self.__log('move', reason, vm, origin, self.__tracked_id(pm))
                 vm.current_pm_id = pm.id
                 pm.running_vms.add(vm)
         pm.update()
         self.pm_group_renew()
 
-    def fillwith(self, vm_x):
-        if self.__exist('ULLT'):
-            pm_b = self.__get('ULLT')
-            self.move(vm_x, pm_b)
-        elif self.__exist('UT'):
-            pm_b = self.__get('UT')
-            self.move(vm_x, pm_b)
+    def fillwith(self, vm_x, reason='change', src=None):
+        # The PM that vm_x is leaving is never chosen, otherwise release() and adjust() may put it back forever.
+        pm_b = self.__get('ULLT', vm=vm_x)
+        if pm_b is None:
+            pm_b = self.__get('UT', vm=vm_x)
+        if pm_b is not None:
+            self.move(vm_x, pm_b, reason, src)
         else:
-            self.new(vm_x)
+            self.new(vm_x, reason, src)
 
     def fill(self, pm_b):
         if pm_b.category == 'L' or pm_b.category == 'LT':
             while pm_b.gap >= 1 / 3 and self.__exist('T'):
+                if self.__interrupt('fill', pm_b):
+                    return
                 if self.__exist('UT'):
                     ut = self.__get('UT')
                     group_choice = self.divide(ut)
                     g = group_choice.pop()
-                    self.move(g, pm_b)
+                    self.move(g, pm_b, 'fill')
                 else:
                     t = self.__get('T')
                     group_choice = self.divide(t)
                     g = group_choice.pop()
-                    self.move(g, pm_b)
+                    self.move(g, pm_b, 'fill')
                 pm_b.update()
 
-    def insert_s_item(self, vm_x):
-        if self.__exist('S'):
-            pm_b = self.__get('S')
-            self.move(vm_x, pm_b)
+    def insert_s_item(self, vm_x, reason='change', src=None):
+        pm_b = self.__get('S', vm=vm_x)
+        if pm_b is not None:
+            self.move(vm_x, pm_b, reason, src)
         else:
-            self.new(vm_x)
+            self.new(vm_x, reason, src)
 
     def release(self, pm):
         pm_id = pm.id
         while len(pm.running_vms) != 0:
+            if self.__interrupt('release', pm):
+                return
             vm = pm.running_vms.pop()
-            self.fillwith(vm)
+            self.fillwith(vm, 'release', self.__tracked_id(pm))
         self.active_pm_id.discard(pm_id)
         self.idle_pm_id.add(pm_id)
         # print('{} is released.'.format(pm_id))
-        self.pm_set[pm_id] = PhysicalMachine(pm_id, 1000)
+        self.__reset(pm_id, 'release')
         self.pm_group_renew()
 
     def adjust(self, pm_b):
         if pm_b.category == 'LT' or pm_b.category == 'T':
             while self.hot(pm_b):
+                if self.__interrupt('adjust', pm_b):
+                    return
                 g = pm_b.running_vms.pop()
-                self.fillwith(g)
+                self.fillwith(g, 'adjust', self.__tracked_id(pm_b))
                 pm_b.update()
             if pm_b.gap >= 1 / 3:
                 self.fill(pm_b)
@@ -274,15 +395,15 @@ class VMScheduler:
             for vm in self.vm_new:
                 # print('VM-{} starts running now.'.format(vm.id))
                 if vm.category == 'B':
-                    self.new(vm)
+                    self.new(vm, 'insert')
                 elif vm.category == 'L':
-                    pm_id = self.new(vm)
+                    pm_id = self.new(vm, 'insert')
                     pm = self.pm_set[pm_id]
                     self.fill(pm)
                 elif vm.category == 'S':
-                    self.insert_s_item(vm)
+                    self.insert_s_item(vm, 'insert')
                 else:
-                    self.fillwith(vm)
+                    self.fillwith(vm, 'insert')
 
     def __exist_s_item(self, pm, vm_x=None):
         num = 0
@@ -337,124 +458,220 @@ class VMScheduler:
             return res
 
     def change(self):
+        # Without a budget every VM's category change is handled at once. Otherwise only the VMs whose PM is hot are
+        # handled now, since an overloaded PM can not wait, and the rest of the work is deferred to run_deferred().
+        if self.op_budget is None and self.time_budget is None:
+            for vm in self.vm_set:
+                self.__handle(vm, vm.pre_category, vm.category)
+            return
+
+        self.__slot = self.system_time
         for vm in self.vm_set:
             pm = self.pm_set[vm.current_pm_id]
-            pre = vm.pre_category
-            cur = vm.category
-            if pre == 'B' and cur == 'L':
-                self.fill(pm)
+            if self.hot(pm):
+                self.__live.pop(vm, None)
+                self.__handle(vm, vm.pre_category, vm.category)
+            elif vm.pre_category is not None and (vm.pre_category, vm.category) not in (('B', 'B'), ('S', 'S')):
+                # B-B and S-S need no adjustment, so there is nothing to defer for them. A VM has at most one live
+                # deferred change: the newer one supersedes the older one but keeps its entry in the queue.
+                self.__live[vm] = (vm.pre_category, vm.category)
+                self.__defer(vm, pm)
+        self.run_deferred()
+
+    def __defer(self, work, pm):
+        # Put the work into the queue unless it already has an entry there.
+        if work not in self.__queued:
+            self.__seq += 1
+            self.__queued.add(work)
+            self.deferred.put((self.__slot, -pm.gap, self.__seq, work))
+
+    def __exhausted(self):
+        # Whether deferred work has used up the budget of current slot.
+        if self.op_budget is not None and self.num_ops >= self.op_budget:
+            return True
+        if self.time_budget is not None and time.perf_counter() - self.__start >= self.time_budget:
+            return True
+        return False
 
-            elif pre == 'B' and cur == 'S':
-                if self.__exist('S', pm):
-                    pm_b = self.__get('S', pm)
+    def __interrupt(self, chain, pm):
+        # In deferred work, a chain of release(), adjust() or fill() stops between two steps once the budget is used
+        # up, and the rest of it is deferred to be continued in a later slot.
+        if not self.__budgeted or not self.__exhausted():
+            return False
+        self.__chains.add((chain, pm))
+        self.__defer((chain, pm), pm)
+        return True
+
+    def run_deferred(self):
+        # Run the deferred work under the per-slot budget, oldest slot first and emptier PMs first within a slot.
+        # Whatever is left carries over into the next slot. The budget is checked between work items and between the
+        # steps of release(), adjust() and fill(), so one step may go over it, which is recorded in op_overshoot.
+        self.num_ops = 0
+        self.op_overshoot = 0
+        self.__start = time.perf_counter()
+        if self.deferred.qsize() > 2 * self.backlog():
+            self.__compact()
+        self.__budgeted = True
+        while not self.deferred.empty() and not self.__exhausted():
+            self.__slot, _, _, work = self.deferred.get()
+            self.__queued.discard(work)
+            if isinstance(work, VirtualMachine):
+                # The work is stale if the VM has been handled or has finished since it was deferred, or its category
+                # has changed again without being deferred.
+                if work not in self.__live:
+                    continue
+                pre, cur = self.__live.pop(work)
+                if work.category != cur:
+                    continue
+                self.__handle(work, pre, cur)
+            else:
+                # The chain is stale if its PM has been re-initialized since it was deferred.
+                self.__chains.discard(work)
+                chain, pm = work
+                if self.__tracked_id(pm) is None:
+                    continue
+                if chain == 'release':
+                    self.release(pm)
+                elif chain == 'adjust':
+                    self.adjust(pm)
+                else:
+                    self.fill(pm)
+        self.__budgeted = False
+        self.__slot = self.system_time
+        if self.op_budget is not None:
+            self.op_overshoot = max(0, self.num_ops - self.op_budget)
+
+    def __compact(self):
+        # Rebuild the queue without the entries of VMs which have been handled or have finished, since they are only
+        # dropped when popped and the budget may leave them in the queue for long.
+        entries = [x for x in self.deferred.queue if x[3] in self.__live or x[3] in self.__chains]
+        self.deferred = PriorityQueue()
+        for x in entries:
+            self.deferred.put(x)
+        self.__queued = set(x[3] for x in entries)
+
+    def backlog(self):
+        # The number of VMs whose category change is deferred and chains which are waiting to be continued.
+        return len(self.__live) + len(self.__chains)
+
+    def __handle(self, vm, pre, cur):
+        # Make a corresponding adjustment according to the change of VM's category.
+        pm = self.pm_set[vm.current_pm_id]
+        if pre == 'B' and cur == 'L':
+            self.fill(pm)
+
+        elif pre == 'B' and cur == 'S':
+            if self.__exist('S', pm):
+                pm_b = self.__get('S', pm)
+                self.move(vm, pm_b)
+
+        elif pre == 'B' and cur == 'T':
+            if self.__exist('ULLT', pm):
+                pm_b = self.__get('ULLT', pm)
+                self.move(vm, pm_b)
+            else:
+                if self.__exist('UT', pm):
+                    pm_b = self.__get('UT', pm)
                     self.move(vm, pm_b)
 
-            elif pre == 'B' and cur == 'T':
-                if self.__exist('ULLT', pm):
-                    pm_b = self.__get('ULLT', pm)
-                    self.move(vm, pm_b)
-                else:
-                    if self.__exist('UT', pm):
-                        pm_b = self.__get('UT', pm)
-                        self.move(vm, pm_b)
+        elif pre == 'L' and cur == 'B':
+            self.release(pm)
 
-            elif pre == 'L' and cur == 'B':
-                self.release(pm)
+        elif pre == 'L' and cur == 'L':
+            self.adjust(pm)
 
-            elif pre == 'L' and cur == 'L':
-                self.adjust(pm)
+        elif pre == 'L' and cur == 'S':
+            if self.__exist('S', pm):
+                pm_b = self.__get('S', pm)
+                self.move(vm, pm_b)
 
-            elif pre == 'L' and cur == 'S':
-                if self.__exist('S', pm):
-                    pm_b = self.__get('S', pm)
-                    self.move(vm, pm_b)
+        elif pre == 'L' and cur == 'T':
+            if self.__exist('T', pm):
+                while self.__exist('UT', pm):
+                    pm_b = self.__get('UT')
+                    group_choice = self.divide(pm)
+                    g = group_choice.pop()
+                    self.move(g, pm_b)
+            else:
+                while self.__exist('ULLT', pm):
+                    pm_b = self.__get('ULLT', pm)
+                    group_choice = self.divide(pm)
+                    g = group_choice.pop()
+                    self.move(g, pm_b)
 
-            elif pre == 'L' and cur == 'T':
-                if self.__exist('T', pm):
-                    while self.__exist('UT', pm):
-                        pm_b = self.__get('UT')
-                        group_choice = self.divide(pm)
-                        g = group_choice.pop()
-                        self.move(g, pm_b)
-                else:
-                    while self.__exist('ULLT', pm):
-                        pm_b = self.__get('ULLT', pm)
-                        group_choice = self.divide(pm)
-                        g = group_choice.pop()
-                        self.move(g, pm_b)
+        elif pre == 'S' and cur == 'B':
+            if self.__exist_s_item(pm):
+                s_item = self.__get_s_item(pm)
+                self.insert_s_item(s_item, src=self.__tracked_id(pm))
 
-            elif pre == 'S' and cur == 'B':
-                if self.__exist_s_item(pm):
-                    s_item = self.__get_s_item(pm)
-                    self.insert_s_item(s_item)
+        elif pre == 'S' and cur == 'L':
+            if self.__exist_s_item(pm):
+                s_item = self.__get_s_item(pm)
+                self.insert_s_item(s_item, src=self.__tracked_id(pm))
+                self.fill(pm)
 
-            elif pre == 'S' and cur == 'L':
+        elif pre == 'S' and cur == 'T':
+            if self.__exist_s_item(pm) and self.__exist('S', pm):
+                s_item = self.__get_s_item(pm)
+                pm_b = self.__get('S', pm)
+                self.move(s_item, pm_b, src=self.__tracked_id(pm))
+            if self.__exist('ULLT', pm):
+                pm_b = self.__get('ULLT', pm)
+                self.move(vm, pm_b)
+            elif self.__exist('UT', pm):
+                pm_b = self.__get('UT', pm)
+                self.move(vm, pm_b)
+            else:
                 if self.__exist_s_item(pm):
-                    s_item = self.__get_s_item(pm)
-                    self.insert_s_item(s_item)
-                    self.fill(pm)
+                    self.new(vm, src=self.__take(pm, vm))
 
-            elif pre == 'S' and cur == 'T':
-                if self.__exist_s_item(pm) and self.__exist('S', pm):
-                    s_item = self.__get_s_item(pm)
-                    pm_b = self.__get('S', pm)
-                    self.move(s_item, pm_b)
-                if self.__exist('ULLT', pm):
-                    pm_b = self.__get('ULLT', pm)
-                    self.move(vm, pm_b)
-                elif self.__exist('UT', pm):
-                    pm_b = self.__get('UT', pm)
-                    self.move(vm, pm_b)
-                else:
-                    if self.__exist_s_item(pm):
-                        pm.running_vms.discard(vm)
-                        self.new(vm)
-
-            elif pre == 'T' and cur == 'B':
-                if self.__exist_l_item(pm):
-                    vm_x = self.__get_l_item(pm)
-                    pm.running_vms.discard(vm_x)
-                    self.new(vm_x)
-                    self.release(pm)
+        elif pre == 'T' and cur == 'B':
+            if self.__exist_l_item(pm):
+                vm_x = self.__get_l_item(pm)
+                pm.running_vms.discard(vm_x)
+                self.new(vm_x, src=self.__tracked_id(pm))
+                self.release(pm)
 
-            elif pre == 'T' and cur == 'L':
-                if self.__exist_l_item(pm, vm):
-                    vm_x = self.__get_l_item(pm, vm)
-                    pm.running_vms.discard(vm_x)
-                    new_pm_id = self.new(vm_x)
-                    self.fill(self.pm_set[new_pm_id])
-                    self.adjust(pm)
+        elif pre == 'T' and cur == 'L':
+            if self.__exist_l_item(pm, vm):
+                vm_x = self.__get_l_item(pm, vm)
+                pm.running_vms.discard(vm_x)
+                new_pm_id = self.new(vm_x, src=self.__tracked_id(pm))
+                self.fill(self.pm_set[new_pm_id])
+                self.adjust(pm)
 
-            elif pre == 'T' and cur == 'S':
-                if self.__exist_l_item(pm):
-                    vm_x = self.__get_l_item(pm)
-                    pm.running_vms.discard(vm_x)
-                    self.insert_s_item(vm)
-                    self.fill(self.pm_set[vm_x.current_pm_id])
-                elif self.__exist('S', pm):
-                    pm_b = self.__get('S')
-                    t_group = self.divide(pm)
-                    while self.__exist('UT', pm) and t_group:
-                        pm_c = self.__get('UT', pm)
-                        g = t_group.pop()
-                        self.move(g, pm_c)
-                    self.move(vm, pm_b)
-                else:
-                    self.release(pm)
+        elif pre == 'T' and cur == 'S':
+            if self.__exist_l_item(pm):
+                vm_x = self.__get_l_item(pm)
+                pm.running_vms.discard(vm_x)
+                # vm_x is taken off pm and not put anywhere else.
+                self.__log('remove', 'change', vm_x, self.__tracked_id(pm), None)
+                self.insert_s_item(vm, src=self.__take(pm, vm))
+                self.fill(self.pm_set[vm_x.current_pm_id])
+            elif self.__exist('S', pm):
+                pm_b = self.__get('S')
+                t_group = self.divide(pm)
+                while self.__exist('UT', pm) and t_group:
+                    pm_c = self.__get('UT', pm)
+                    g = t_group.pop()
+                    self.move(g, pm_c)
+                self.move(vm, pm_b)
+            else:
+                self.release(pm)
 
-            elif pre == 'T' and cur == 'T':
-                if self.__exist_l_item(pm, vm):
-                    self.adjust(pm)
+        elif pre == 'T' and cur == 'T':
+            if self.__exist_l_item(pm, vm):
+                self.adjust(pm)
+            else:
+                if self.hot(pm):
+                    self.fillwith(vm)
+                    self.__remove(pm, vm, 'change')
                 else:
-                    if self.hot(pm):
-                        self.fillwith(vm)
-                        pm.running_vms.discard(vm)
-                    else:
-                        while pm.gap >= 1 / 3 and self.__exist('UT', pm):
-                            pm_b = self.__get('UT', pm)
-                            t_group = self.divide(pm_b)
-                            g = t_group.pop()
-                            self.move(g, pm)
+                    while pm.gap >= 1 / 3 and self.__exist('UT', pm):
+                        pm_b = self.__get('UT', pm)
+                        t_group = self.divide(pm_b)
+                        g = t_group.pop()
+                        self.move(g, pm)
 
-            else:
-                pass
+        else:
+            pass
@@ -6,45 +6,114 @@
 # @File    : simulation.py
 # @Software: PyCharm
 
+import copy
+import math
+import time
 from queue import PriorityQueue
 from generate_data import gen_data
 from scheduler import VMScheduler
+from decision_log import DecisionLog, replay_slots
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of a list of values.
+    values = sorted(values)
+    rank = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[rank]
+
+
+def simulate(vm_list, num_pms, num_slots, op_budget=None, time_budget=None, log_path=None, departure_aware=False,
+             check_log=False):
+    # Run the scheduler over all slots, and return the number of PM-slots consumed, the number of migrations,
+    # the time taken by each slot, the number of deferred category changes after each slot and the number of PM
+    # group renewals over op_budget in each slot. If check_log is set, the occupancy of PMs is kept for every slot
+    # and compared with a replay of the log at the end, which costs memory in proportion to slots and VMs.
+    pq = PriorityQueue()
+    for vm in vm_list:
+        pq.put(vm)
+
+    log = None if log_path is None else DecisionLog(log_path)
+    vmm = VMScheduler(num_pms, num_slots, op_budget, time_budget, log, departure_aware)
+    pm_slots = 0
+    tick_times = list()
+    backlogs = list()
+    overshoots = list()
+    occupancies = list()
+
+    try:
+        for t in range(num_slots + 1):
+            print('The {}th slot.'.format(t))
+            start = time.perf_counter()
+            vmm.system_time = t
+            cur_vm_list = list()
+            while not pq.empty():
+                vm = pq.get()
+                if vm.start_time == t:
+                    cur_vm_list.append(vm)
+                else:
+                    pq.put(vm)
+                    break
+
+            vmm.vm_new = cur_vm_list
+            # Arrange the new coming VMs on suitable PMs.
+            vmm.insert()
+            # Update the demand of running VMs.
+            vmm.vm_re_categorize(t)
+            # Update the category of active PMs.
+            vmm.pm_re_categorize()
+            # According to the change of VM's category, make a corresponding adjustment.
+            vmm.change()
+            # Integrate the set of new VMs and old VMs.
+            vmm.integrate_vm_set()
+            # Update the category of PMs.
+            vmm.pm_re_categorize()
+            vmm.pm_group_renew()
+            tick_times.append(time.perf_counter() - start)
+            backlogs.append(vmm.backlog())
+            overshoots.append(vmm.op_overshoot)
+            pm_slots += len(vmm.active_pm_id)
+            if log is not None:
+                if check_log:
+                    occupancies.append(vmm.occupancy())
+                log.flush()
+            print('{} category changes are deferred.'.format(backlogs[-1]))
+    finally:
+        if log is not None:
+            log.close()
+
+    if log is not None and check_log:
+        # Check that replaying the log alone rebuilds the occupancy of PMs at the end of every slot.
+        mismatches = [t for t, occupancy in replay_slots(log_path, num_slots) if occupancy != occupancies[t]]
+        print('Replay of {} differs from the scheduler in {} slots.'.format(log_path, len(mismatches)))
+    return pm_slots, vmm.num_migrations, tick_times, backlogs, overshoots
+
 
 if __name__ == "__main__":
     # Generate the input
     num_vms = 1000
     num_slots = 1000
     num_pms = num_vms
+    # Budget of deferred work in each slot, None means that all work is done in the slot it arises.
+    op_budget = None
+    time_budget = None
+    # File that placement decisions are logged to, None means that no decision is logged.
+    log_path = None
+    # Whether to check that replaying the log rebuilds the occupancy of PMs in every slot.
+    check_log = False
     vm_list = gen_data(num_vms, num_slots)
 
-    pq = PriorityQueue()
-    for vm in vm_list:
-        pq.put(vm)
+    # Compare plain VISBP with departure-aware placement on the same input.
+    results = dict()
+    for mode, departure_aware in (('VISBP', False), ('Departure-aware', True)):
+        path = None if log_path is None else '{}.{}'.format(log_path, mode)
+        results[mode] = simulate(copy.deepcopy(vm_list), num_pms, num_slots, op_budget, time_budget, path,
+                                 departure_aware, check_log)
 
-    vmm = VMScheduler(num_pms, num_slots)
-
-    for t in range(num_slots + 1):
-        print('The {}th slot.'.format(t))
-        cur_vm_list = list()
-        while not pq.empty():
-            vm = pq.get()
-            if vm.start_time == t:
-                cur_vm_list.append(vm)
-            else:
-                pq.put(vm)
-                break
-
-        vmm.vm_new = cur_vm_list
-        # Arrange the new coming VMs on suitable PMs.
-        vmm.insert()
-        # Update the demand of running VMs.
-        vmm.vm_re_categorize(t)
-        # Update the category of active PMs.
-        vmm.pm_re_categorize()
-        # According to the change of VM's category, make a corresponding adjustment.
-        vmm.change()
-        # Integrate the set of new VMs and old VMs.
-        vmm.integrate_vm_set()
-        # Update the category of PMs.
-        vmm.pm_re_categorize()
-        vmm.pm_group_renew()
+    for mode, (pm_slots, migrations, tick_times, backlogs, overshoots) in results.items():
+        print('{}:'.format(mode))
+        print(' - PM-slots consumed: {}, migrations: {}'.format(pm_slots, migrations))
+        for p in (50, 90, 99, 100):
+            print(' - p{} tick time: {:.6f}s'.format(p, percentile(tick_times, p)))
+        print(' - Max backlog: {}, final backlog: {}'.format(max(backlogs), backlogs[-1]))
+        print(' - Max op budget overshoot: {}, slots over budget: {}'.format(
+            max(overshoots), sum(1 for x in overshoots if x > 0)))